@@ -1,4 +1,3 @@
-from copy import deepcopy
 from os.path import join, exists
 from pathlib import Path
 
@@ -98,14 +97,18 @@ if __name__ == "__main__":
     else:
         optimizer = SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=0.0005)
         best_loss = float("inf")
-        best_model_state_dict = None
+        # preallocate the best state once and copy into it, instead of deep copying it on every improvement.
+        best_model_state_dict = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
         for epoch in range(1, epochs + 1):
             train(model, device, train_loader, optimizer, epoch)
             test_loss = evaluate()
             if test_loss < best_loss:
                 best_loss = test_loss
-                best_model_state_dict = deepcopy(model.state_dict())
-        save(model.state_dict(), checkpoint_file_dir)
+                with no_grad():
+                    for name, tensor in model.state_dict().items():
+                        best_model_state_dict[name].copy_(tensor)
+        model.load_state_dict(best_model_state_dict)
+        save(best_model_state_dict, checkpoint_file_dir)
 
     print(f"Plotting the loss landscape for {file_name}")
     plot_loss_landscape_3d(optimal_parameters=model.parameters(),
@@ -1,31 +1,108 @@
 from math import sqrt
-from unittest import TestCase, main
+from unittest import TestCase, main, skipUnless
+from unittest.mock import patch
 
 import torch
-from torch import allclose, norm, rand, sign, sort, tensor, cat, dist, stack
+from torch import allclose, arange, cov, dot, eye, linalg, norm, rand, randn, sign, sort, tensor, cat, dist, stack
 from torch.linalg import eigh
 from torch.nn import Linear
 from torch.nn.utils import parameters_to_vector
 
-from torch_landscape.directions import PcaDirections, RandomDirections, normalize_direction, SvdDirections
+from torch_landscape.directions import (
+    GRAM_MAX_SAMPLES,
+    PcaDirections,
+    RandomDirections,
+    SvdDirections,
+    normalize_direction,
+    normalize_direction_using_params,
+)
 
 
 class DirectionsTest(TestCase):
-    def test_calculate_covariance_matrix(self):
+    def test_create_pca_directions_covariance_example(self):
         """
-        Tests the calculation of a covariance matrix.
+        Tests if the PCA directions are the eigenvectors of the covariance matrix of the samples.
         Example is from https://jamesmccaffrey.wordpress.com/2017/11/03/example-of-calculating-a-covariance-matrix/.
         """
         samples = [
-            tensor([64, 580, 29]),
-            tensor([66, 570, 33]),
-            tensor([68, 590, 37]),
-            tensor([69, 660, 46]),
-            tensor([73, 600, 55]),
+            [tensor([64.0, 580, 29])],
+            [tensor([66.0, 570, 33])],
+            [tensor([68.0, 590, 37])],
+            [tensor([69.0, 660, 46])],
+            [tensor([73.0, 600, 55])],
         ]
-        expected_matrix = tensor([[11.5, 50, 34.75], [50, 1250, 205], [34.75, 205, 110]])
-        actual_matrix = PcaDirections.calculate_covariance_matrix(samples)
-        self.assertTrue(allclose(actual_matrix, expected_matrix))
+        covariance_matrix = tensor([[11.5, 50, 34.75], [50, 1250, 205], [34.75, 205, 110]])
+        eigen_values, eigen_vectors = eigh(covariance_matrix)
+        expected_b1 = eigen_vectors[:, -1]
+        expected_b2 = eigen_vectors[:, -2]
+
+        b1, b2 = PcaDirections.create_pca_directions(samples, samples[0])
+
+        # correct signs of eigenvectors if necessary.
+        expected_b1 *= sign(b1[0] * expected_b1[0]).item()
+        expected_b2 *= sign(b2[0] * expected_b2[0]).item()
+
+        self.assertTrue(allclose(expected_b1, b1, atol=1e-4))
+        self.assertTrue(allclose(expected_b2, b2, atol=1e-4))
+
+    def test_calculate_gram_matrix(self):
+        """
+        Tests if the gram matrix has the same non-zero eigenvalues as the covariance matrix.
+        Example is from https://jamesmccaffrey.wordpress.com/2017/11/03/example-of-calculating-a-covariance-matrix/.
+        """
+        samples = tensor([[64.0, 580, 29], [66, 570, 33], [68, 590, 37], [69, 660, 46], [73, 600, 55]])
+        covariance_matrix = tensor([[11.5, 50, 34.75], [50, 1250, 205], [34.75, 205, 110]])
+        expected_eigen_values = eigh(covariance_matrix).eigenvalues
+
+        gram_matrix = PcaDirections.calculate_gram_matrix(samples - samples.mean(dim=0))
+
+        self.assertEqual((5, 5), tuple(gram_matrix.shape))
+        self.assertTrue(allclose(expected_eigen_values, eigh(gram_matrix).eigenvalues[-3:], rtol=1e-4))
+
+    def test_calculate_gram_matrix_low_precision(self):
+        """
+        Tests if the gram matrix calculated in bfloat16 is close to the one calculated in full precision.
+        """
+        samples = rand(5, 100)
+        samples -= samples.mean(dim=0)
+
+        expected_matrix = PcaDirections.calculate_gram_matrix(samples)
+        actual_matrix = PcaDirections.calculate_gram_matrix(samples, low_precision=True)
+
+        self.assertEqual(samples.dtype, actual_matrix.dtype)
+        self.assertTrue(allclose(expected_matrix, actual_matrix, atol=5e-2))
+
+    @skipUnless(torch.cuda.is_available(), "requires a gpu")
+    def test_create_pca_directions_gpu_samples_on_cpu(self):
+        """
+        Tests if the PCA directions of samples on the gpu, which are copied into pinned memory, are equal to the
+        directions calculated from the samples on the cpu.
+        """
+        samples = [[rand(4, 3), rand(3)] for _ in range(5)]
+        gpu_samples = [[parameter.cuda() for parameter in sample] for sample in samples]
+
+        expected_b1, expected_b2 = PcaDirections.create_pca_directions(samples, samples[0])
+        b1, b2 = PcaDirections.create_pca_directions(gpu_samples, gpu_samples[0], pca_device="cpu")
+
+        self.assertEqual("cpu", b1.device.type)
+        self.assertAlmostEqual(1.0, abs(dot(expected_b1, b1)).item(), 4)
+        self.assertAlmostEqual(1.0, abs(dot(expected_b2, b2)).item(), 4)
+
+    def test_create_pca_directions_low_precision_many_samples(self):
+        """
+        Tests if the PCA directions of many samples use the bfloat16 gram matrix, if low precision is set.
+        """
+        samples = [[rand(8)] for _ in range(GRAM_MAX_SAMPLES + 16)]
+
+        with patch.object(
+            PcaDirections, "calculate_gram_matrix", wraps=PcaDirections.calculate_gram_matrix
+        ) as calculate_gram_matrix:
+            b1, b2 = PcaDirections.create_pca_directions(samples, samples[0], low_precision=True)
+
+        calculate_gram_matrix.assert_called_once()
+        self.assertTrue(calculate_gram_matrix.call_args.args[1])
+        self.assertEqual((8,), tuple(b1.shape))
+        self.assertEqual((8,), tuple(b2.shape))
 
     def test_create_pca_directions_intermediate_parameters_with_loss(self):
         """
@@ -39,6 +116,35 @@ class DirectionsTest(TestCase):
         expected_parameters = [s1[0], s2[0]]
         self.assertSequenceEqual(expected_parameters, directions._intermediate_parameters)
 
+    def test_create_directions_parameters_requiring_grad(self):
+        """
+        Tests if the directions can be calculated from the parameters of a model and snapshots of it, which both
+        require grad, and if the direction vectors are detached from them.
+        """
+        parameters = [*Linear(3, 2).parameters()]
+        samples = [[parameter.clone() for parameter in Linear(3, 2).parameters()] for _ in range(5)]
+        calculations = {
+            "pca": lambda: PcaDirections(parameters, samples).calculate_directions(),
+            "pca static": lambda: PcaDirections.create_pca_directions(samples, parameters),
+            "pca low precision": lambda: PcaDirections.create_pca_directions(samples, parameters, low_precision=True),
+            "svd": lambda: SvdDirections(parameters, samples).calculate_directions(),
+            "svd static": lambda: SvdDirections.create_learnable_directions(samples, parameters),
+            "svd low memory": lambda: SvdDirections.create_learnable_directions(samples, parameters, low_memory=True),
+            "svd low precision": lambda: SvdDirections.create_learnable_directions(
+                samples, parameters, low_precision=True
+            ),
+            "svd batched": lambda: SvdDirections.create_learnable_directions_batched([samples], [parameters])[0],
+        }
+
+        for name, calculate in calculations.items():
+            with self.subTest(name):
+                for direction in calculate():
+                    if isinstance(direction, list):
+                        self.assertEqual([parameter.shape for parameter in parameters], [d.shape for d in direction])
+                    else:
+                        self.assertEqual((8,), direction.shape)
+                        self.assertIsNone(direction.grad_fn)
+
     def test_create_pca_directions_from_example(self):
         """
         Tests if the PCA eigenvectors are calculated correctly
@@ -54,9 +160,51 @@ class DirectionsTest(TestCase):
 
         expected_b1 = tensor([-0.55739, 0.8303])
         expected_b2 = tensor([-0.8303, -0.5574])
+        # correct signs of eigenvectors if necessary.
+        expected_b1 *= sign(b1[0] * expected_b1[0]).item()
+        expected_b2 *= sign(b2[0] * expected_b2[0]).item()
         self.assertTrue(allclose(expected_b1, b1, atol=1e-4))
         self.assertTrue(allclose(expected_b2, b2, atol=1e-4))
 
+    def test_create_pca_directions_two_samples(self):
+        """
+        Tests if the PCA directions of two samples are orthonormal and span the plane of the samples and the
+        optimized parameters.
+        """
+        optimized_parameters = [tensor([1.0, 2.0]), tensor([3.0])]
+        s1 = [tensor([2.0, 2.0]), tensor([4.0])]
+        s2 = [tensor([0.0, 5.0]), tensor([3.0])]
+
+        b1, b2 = PcaDirections.create_pca_directions([s1, s2], optimized_parameters)
+
+        basis = stack([b1, b2], dim=1)
+        self.assertTrue(allclose(basis.T @ basis, eye(2), atol=1e-6))
+        for sample in [s1, s2]:
+            difference = parameters_to_vector(sample) - parameters_to_vector(optimized_parameters)
+            self.assertTrue(allclose(basis @ (basis.T @ difference), difference, atol=1e-5))
+
+    def test_create_pca_directions_one_sample(self):
+        """
+        Tests if the PCA directions cannot be calculated from a single sample.
+        """
+        s1 = [tensor([2.0, 2.0]), tensor([4.0])]
+        with self.assertRaises(ValueError):
+            PcaDirections.create_pca_directions([s1], s1)
+
+    def test_create_svd_directions_one_sample(self):
+        """
+        Tests if the SVD directions cannot be calculated from a single sample.
+        """
+        s1 = [tensor([2.0, 2.0]), tensor([4.0])]
+        calculations = {
+            "svd": lambda: SvdDirections.create_learnable_directions([s1], s1),
+            "svd low memory": lambda: SvdDirections.create_learnable_directions([s1], s1, low_memory=True),
+            "svd batched": lambda: SvdDirections.create_learnable_directions_batched([[s1]], [s1]),
+        }
+        for name, calculate in calculations.items():
+            with self.subTest(name), self.assertRaises(ValueError):
+                calculate()
+
     def test_create_svd_directions_from_example(self):
         """
         Tests if the SVD directions are calculated correctly
@@ -79,16 +227,128 @@ class DirectionsTest(TestCase):
 
         self.assertTrue(dist(dataset, dataset @ V.T @ V) < 1e-5)
 
-    def test_create_pca_directions_vectors_lobpcg(self):
+    def test_create_svd_directions_randomized(self):
+        """
+        Tests if the SVD directions of many intermediate results, which are calculated using a randomized range finder,
+        are equal to the right singular vectors of the full SVD.
+        """
+        optimized_parameters = [rand(40)]
+        directions = linalg.qr(rand(40, 2)).Q
+        coordinates = rand(SvdDirections.gram_max_samples + 16, 2) * tensor([10.0, 5.0])
+        samples = [
+            [optimized_parameters[0] + directions @ coordinate + 1e-3 * rand(40)] for coordinate in coordinates
+        ]
+
+        b1, b2 = SvdDirections.create_learnable_directions(samples, optimized_parameters)
+
+        dataset = stack([parameters_to_vector(sample) - optimized_parameters[0] for sample in samples])
+        _, _, Vh = linalg.svd(dataset, full_matrices=False)
+        self.assertAlmostEqual(1.0, abs(dot(Vh[0], b1)).item(), 4)
+        self.assertAlmostEqual(1.0, abs(dot(Vh[1], b2)).item(), 4)
+
+    def test_create_svd_directions_randomized_slowly_decaying_spectrum(self):
+        """
+        Tests if the randomized SVD directions are equal to the right singular vectors of the full SVD, if the singular
+        values decay slowly like for the intermediate results of a training run.
         """
-        Tests if the PCA directions are calculated correctly using LOBPCG algorithm by comparing
+        samples_count = SvdDirections.gram_max_samples + 16
+        optimized_parameters = [rand(2000)]
+        left_vectors = linalg.qr(randn(samples_count, samples_count)).Q
+        right_vectors = linalg.qr(randn(2000, samples_count)).Q
+        singular_values = 0.9 ** arange(samples_count, dtype=torch.float32)
+        dataset = (left_vectors * singular_values) @ right_vectors.T
+        samples = [[optimized_parameters[0] + difference] for difference in dataset]
+
+        b1, b2 = SvdDirections.create_learnable_directions(samples, optimized_parameters)
+
+        _, _, Vh = linalg.svd(dataset, full_matrices=False)
+        self.assertAlmostEqual(1.0, abs(dot(Vh[0], b1)).item(), 3)
+        self.assertAlmostEqual(1.0, abs(dot(Vh[1], b2)).item(), 3)
+
+    def test_create_svd_directions_low_precision(self):
+        """
+        Tests if the SVD directions calculated from the bfloat16 matrix are close to the float32 directions.
+        """
+        optimized_parameters = [rand(40)]
+        directions = linalg.qr(rand(40, 2)).Q
+        coordinates = rand(8, 2) * tensor([10.0, 5.0])
+        samples = [[optimized_parameters[0] + directions @ coordinate] for coordinate in coordinates]
+
+        expected_b1, expected_b2 = SvdDirections.create_learnable_directions(samples, optimized_parameters)
+        b1, b2 = SvdDirections.create_learnable_directions(samples, optimized_parameters, low_precision=True)
+
+        self.assertAlmostEqual(1.0, abs(dot(expected_b1, b1)).item(), 2)
+        self.assertAlmostEqual(1.0, abs(dot(expected_b2, b2)).item(), 2)
+
+    def test_create_svd_directions_batched(self):
+        """
+        Tests if the batched SVD directions are equal to the directions calculated for each run separately.
+        """
+        batch_of_parameters = [[rand(4, 3), rand(3)] for _ in range(3)]
+        batch_of_samples = [[[rand(4, 3), rand(3)] for _ in range(5)] for _ in range(3)]
+
+        batched_directions = SvdDirections.create_learnable_directions_batched(batch_of_samples, batch_of_parameters)
+
+        self.assertEqual(3, len(batched_directions))
+        for (b1, b2), samples, parameters in zip(batched_directions, batch_of_samples, batch_of_parameters):
+            expected_b1, expected_b2 = SvdDirections.create_learnable_directions(samples, parameters)
+            self.assertAlmostEqual(1.0, abs(dot(expected_b1, b1)).item(), 4)
+            self.assertAlmostEqual(1.0, abs(dot(expected_b2, b2)).item(), 4)
+
+    def test_create_svd_directions_low_memory(self):
+        """
+        Tests if the SVD directions calculated without the matrix of all intermediate parameters are equal to the
+        ones calculated with the matrix.
+        """
+        optimized_parameters = [rand(4, 3), rand(3)]
+        samples = [[rand(4, 3), rand(3)] for _ in range(6)]
+
+        expected_b1, expected_b2 = SvdDirections.create_learnable_directions(samples, optimized_parameters)
+        b1, b2 = SvdDirections(optimized_parameters, samples, low_memory=True).calculate_directions()
+
+        self.assertAlmostEqual(1.0, abs(dot(expected_b1, parameters_to_vector(b1))).item(), 4)
+        self.assertAlmostEqual(1.0, abs(dot(expected_b2, parameters_to_vector(b2))).item(), 4)
+
+    def test_calculate_directions_cached(self):
+        """
+        Tests if repeated calls of calculate_directions reuse the decomposition, but return new parameter lists, and
+        if the decomposition is calculated again when intermediate results are appended.
+        """
+        calculations = {
+            "pca": (PcaDirections, "create_pca_directions"),
+            "svd": (SvdDirections, "create_learnable_directions"),
+        }
+        for name, (directions_class, create_directions) in calculations.items():
+            with self.subTest(name):
+                optimized_parameters = [rand(4, 3), rand(3)]
+                samples = [[rand(4, 3), rand(3)] for _ in range(5)]
+                directions = directions_class(optimized_parameters, samples)
+
+                b1, b2 = directions.calculate_directions()
+                with patch.object(directions_class, create_directions) as create_directions_mock:
+                    same_b1, same_b2 = directions.calculate_directions()
+                create_directions_mock.assert_not_called()
+
+                for b1_i, b2_i, same_b1_i, same_b2_i in zip(b1, b2, same_b1, same_b2):
+                    self.assertTrue(allclose(b1_i, same_b1_i))
+                    self.assertTrue(allclose(b2_i, same_b2_i))
+                    self.assertIsNot(b1_i, same_b1_i)
+
+                samples.append([rand(4, 3), rand(3)])
+                expected_b1, _ = getattr(directions_class, create_directions)(samples, optimized_parameters)
+                new_b1, _ = directions.calculate_directions()
+                self.assertAlmostEqual(1.0, abs(dot(expected_b1, parameters_to_vector(new_b1))).item(), 4)
+
+    def test_create_pca_directions_vectors_randomized(self):
+        """
+        Tests if the PCA directions are calculated correctly using the randomized range finder by comparing
         results with calculations of "eigh".
         """
-        samples = [[rand(8)] for _ in range(10)]
+        samples = [[rand(8)] for _ in range(GRAM_MAX_SAMPLES + 16)]
 
         results = [parameters_to_vector(result) for result in samples]
-        covariance_matrix = PcaDirections.calculate_covariance_matrix(results)
-        # calculate directions using "eigh" in test - should be equal for this small example to LOBPCG result.
+        covariance_matrix = cov(stack(results, dim=1))
+        # calculate directions using "eigh" in test - should be equal for this small example to the SVD result.
         eigen_values, eigen_vectors = eigh(covariance_matrix)
         _, indices = sort(eigen_values, descending=True)
         expected_b1 = eigen_vectors[:, indices[0]]
@@ -161,6 +421,20 @@ class DirectionsTest(TestCase):
         self.assertEqual(parameters[1].shape, b1[1].shape)
         self.assertEqual(parameters[1].shape, b2[1].shape)
 
+    def test_create_random_directions_with_seed(self):
+        """
+        Tests if create_random_directions creates the same directions for the same seed.
+        """
+        model = Linear(4, 2)
+        b1, b2 = RandomDirections(model=model).calculate_directions(seed=7)
+        same_b1, same_b2 = RandomDirections(model=model).calculate_directions(seed=7)
+        other_b1, _ = RandomDirections(model=model).calculate_directions(seed=8)
+        for b1_i, b2_i, same_b1_i, same_b2_i in zip(b1, b2, same_b1, same_b2):
+            self.assertTrue(allclose(b1_i, same_b1_i))
+            self.assertTrue(allclose(b2_i, same_b2_i))
+        self.assertFalse(allclose(b1[0], b2[0]))
+        self.assertFalse(allclose(b1[0], other_b1[0]))
+
     def test_create_random_directions_check_normalization(self):
         """
         Tests if create_random_directions normalizes the directions with filter normalization.
@@ -208,5 +482,20 @@ class DirectionsTest(TestCase):
         self.assertAlmostEqual(norm_parameters_row1, norm_direction_row1, 4)
         self.assertAlmostEqual(norm_parameters_row2, norm_direction_row2, 4)
 
+    def test_normalize_direction_using_params_vectors(self):
+        """
+        Tests if the normalization of all vectors at once gives the same result as normalizing each tensor.
+        """
+        parameters = [tensor([[1.0, 2.0], [3.0, 4.0]]), tensor([4.0, 5.0, 6.0]), tensor([0.5, -1.5])]
+        direction = [tensor([[0.4, 0.6], [-0.3, 0.9]]), tensor([2.0, -5.0, -2.0]), tensor([0.1, 0.3])]
+        expected_direction = [direction_i.clone() for direction_i in direction]
+        for direction_i, parameters_i in zip(expected_direction, parameters):
+            normalize_direction(direction_i, parameters_i)
+
+        normalize_direction_using_params(direction, parameters)
+
+        for expected_direction_i, direction_i in zip(expected_direction, direction):
+            self.assertTrue(allclose(expected_direction_i, direction_i))
+
 if __name__ == "__main__":
     main()
@@ -1,19 +1,15 @@
 from abc import ABC, abstractmethod
-from copy import deepcopy
-from logging import getLogger
-from math import sqrt
+from logging import INFO, getLogger
+from operator import itemgetter
 from typing import Callable, Iterable, List, Optional, Tuple, Union
 
 import torch
-from torch import Tensor, cov, cuda, device, lobpcg, randn, sort, stack, sum, svd_lowrank
-from torch.linalg import eigh
-from torch.nn import Module, MSELoss, Parameter, ParameterList, init
-from torch.nn.utils import parameters_to_vector, vector_to_parameters
-from torch.optim import Adam
-from tqdm import tqdm
+from torch import Generator, Tensor, device, randn, stack
+from torch.linalg import eigh, qr, svd
+from torch.nn import Module
+from torch.nn.utils import parameters_to_vector
 
-from torch_landscape.subspace import NonlinearSubspace, LinearSubspace, Subspace
-from torch_landscape.utils import clone_parameters
+from torch_landscape.utils import parameters_to_matrix
 
 
 def normalize_direction_using_params(direction: List[Tensor], parameters: List[Tensor]):
@@ -25,8 +21,20 @@ def normalize_direction_using_params(direction: List[Tensor], parameters: List[T
     :return: None
     """
     assert len(direction) == len(parameters)
+    vector_directions, vector_parameters = [], []
     for direction_i, parameter_i in zip(direction, parameters):
-        normalize_direction(direction_i, parameter_i)
+        if parameter_i.dim() > 1:
+            normalize_direction(direction_i, parameter_i)
+        else:
+            vector_directions.append(direction_i)
+            vector_parameters.append(parameter_i)
+
+    if len(vector_directions) > 0:
+        # vectors are normalized using the norm of all their elements, which can be calculated for all at once.
+        norm_directions = torch._foreach_norm(vector_directions)
+        norm_parameters = torch._foreach_norm(vector_parameters)
+        torch._foreach_add_(norm_directions, 1e-10)
+        torch._foreach_mul_(vector_directions, torch._foreach_div(norm_parameters, norm_directions))
 
 
 def normalize_direction(direction: Tensor, parameters: Tensor):
@@ -47,6 +55,91 @@ def normalize_direction(direction: Tensor, parameters: Tensor):
     direction *= scaling_factor
 
 
+# small decompositions are dominated by the kernel launches on the gpu, so matrices up to this size are moved to the
+# cpu, where lapack solves them faster. Only the small matrices are moved, never the NxF samples.
+CPU_DECOMPOSITION_MAX_SIZE = 256
+
+# the maximal count of samples for which directions are calculated from the eigenpairs of the NxN gram matrix, which
+# is faster than the randomized range finder with power iterations up to a few hundred samples.
+GRAM_MAX_SAMPLES = 256
+
+
+def _decomposition_device(matrix: Tensor) -> device:
+    """
+    Gets the device on which a small matrix should be decomposed.
+    :param matrix: The matrix to decompose.
+    :return: The cpu for small matrices on the gpu, otherwise the device of the matrix.
+    """
+    if matrix.is_cuda and max(matrix.shape[-2:]) <= CPU_DECOMPOSITION_MAX_SIZE:
+        return device("cpu")
+    return matrix.device
+
+
+def calculate_largest_eigenpairs(gram_matrix: Tensor, count: int = 2) -> Tuple[Tensor, Tensor]:
+    """
+    Calculates the largest eigenpairs of a small symmetric matrix, or of a batch of them.
+
+    :param gram_matrix: The symmetric matrix, usually the gram matrix of some samples, optionally with leading batch
+    dimensions.
+    :param count: The count of eigenpairs to calculate.
+    :return: The eigenvalues in descending order and the eigenvectors as columns, on the device of the matrix.
+    """
+    eigen_values, eigen_vectors = eigh(gram_matrix.to(device=_decomposition_device(gram_matrix)))
+    # eigh returns the eigenvalues in ascending order, so only the last ones are reversed and kept.
+    eigen_values = eigen_values[..., -count:].flip(-1).to(device=gram_matrix.device)
+    eigen_vectors = eigen_vectors[..., -count:].flip(-1).to(device=gram_matrix.device)
+    return eigen_values, eigen_vectors
+
+
+def calculate_gram_eigenpairs(samples: Tensor, gram_matrix: Tensor, count: int = 2) -> Tuple[Tensor, Tensor]:
+    """
+    Calculates the largest eigenpairs of the gram matrix of the samples and maps its eigenvectors to the right
+    singular vectors of the samples, which are the eigenvectors of the (much larger) matrix samples.T @ samples.
+
+    :param samples: The samples as matrix of size NxF, or a batch of them of size BxNxF.
+    :param gram_matrix: The (scaled) gram matrix samples @ samples.T of size NxN, or a batch of them of size BxNxN.
+    :param count: The count of eigenpairs to calculate.
+    :return: The eigenvalues of the gram matrix in descending order and the right singular vectors as columns.
+    """
+    eigen_values, gram_eigen_vectors = calculate_largest_eigenpairs(gram_matrix, count)
+    # map the eigenvectors to the parameter space, qr also completes the basis for zero eigenvalues.
+    singular_vectors = samples.mT @ gram_eigen_vectors.to(device=samples.device, dtype=samples.dtype)
+    # the qr decomposition runs in the dtype of the gram matrix, which is more precise for low precision samples.
+    singular_vectors, _ = qr(singular_vectors.to(dtype=gram_eigen_vectors.dtype))
+    return eigen_values, singular_vectors
+
+
+def calculate_randomized_singular_vectors(
+    samples: Tensor, count: int = 2, oversampling: int = 5, iterations: int = 0, seed: int = 0
+) -> Tuple[Tensor, Tensor]:
+    """
+    Approximates the largest right singular vectors of the samples using the randomized range finder of Halko et al.:
+    the samples are multiplied with a random matrix, the range of the product is orthonormalized with a qr
+    decomposition and the small projection of the samples onto this range is decomposed exactly.
+
+    :param samples: The samples as matrix of size NxF.
+    :param count: The count of singular vectors to calculate.
+    :param oversampling: The count of additional random vectors, which improve the accuracy of the approximation.
+    :param iterations: The count of power iterations, which can be used to sharpen a slowly decaying spectrum.
+    :param seed: The seed of the random matrix, so that the result is deterministic.
+    :return: The singular values in descending order and the right singular vectors as columns.
+    """
+    rank = min(count + oversampling, *samples.shape)
+    generator = Generator(device=samples.device)
+    generator.manual_seed(seed)
+    random_matrix = randn(samples.size(dim=1), rank, generator=generator, device=samples.device, dtype=samples.dtype)
+    range_basis, _ = qr(samples @ random_matrix)
+    for _ in range(iterations):
+        row_basis, _ = qr(samples.T @ range_basis)
+        range_basis, _ = qr(samples @ row_basis)
+    # the projection of size (C+P)xF is small and can be decomposed exactly.
+    projection = range_basis.T @ samples
+    projection = projection.to(device=_decomposition_device(projection))
+    _, singular_values, projection_vectors = svd(projection, full_matrices=False)
+    singular_values = singular_values[:count].to(device=samples.device)
+    return singular_values, projection_vectors[:count].T.to(device=samples.device)
+
+
 class Directions(ABC):
     """
     Abstract class which describes the methods to calculate directions.
@@ -58,6 +151,62 @@ class Directions(ABC):
         :param optimized_parameters: The optimized parameters of the model.
         """
         self._optimized_parameters = optimized_parameters
+        self._optimized_parameters_vector_cache: Optional[Tensor] = None
+        self._parameter_sizes: Optional[List[int]] = None
+        self._cached_directions: Optional[Tuple[tuple, Tensor, Tensor]] = None
+
+    @property
+    def _optimized_parameters_vector(self) -> Tensor:
+        """
+        The optimized parameters as a single vector, which is created once on first use.
+        """
+        if self._optimized_parameters_vector_cache is None:
+            self._optimized_parameters_vector_cache = parameters_to_vector(self._optimized_parameters).detach()
+        return self._optimized_parameters_vector_cache
+
+    def _vectors_to_parameters(self, b1: Tensor, b2: Tensor) -> Tuple[List[Tensor], List[Tensor]]:
+        """
+        Splits two direction vectors into tensors of the same shapes as the optimized parameters. Both vectors are
+        stacked into one new tensor, which is split once for both of them, so the returned tensors are views of it.
+        :param b1: The first direction as vector.
+        :param b2: The second direction as vector.
+        :return: The two directions in the parameter space.
+        """
+        if self._parameter_sizes is None:
+            self._parameter_sizes = [parameter.numel() for parameter in self._optimized_parameters]
+        b1_param, b2_param = [], []
+        for chunk, parameter in zip(stack([b1, b2]).split(self._parameter_sizes, dim=1), self._optimized_parameters):
+            b1_param.append(chunk[0].view_as(parameter))
+            b2_param.append(chunk[1].view_as(parameter))
+        return b1_param, b2_param
+
+    def _calculate_cached_directions(
+        self,
+        intermediate_parameters: List[List[Tensor]],
+        calculate_vectors: Callable[[], Tuple[Tensor, Tensor]],
+        *options,
+    ) -> Tuple[List[Tensor], List[Tensor]]:
+        """
+        Calculates two direction vectors from the intermediate parameters, and splits them into the shapes of the
+        optimized parameters. The vectors are cached with a signature, which identifies the intermediate and
+        optimized parameter tensors by their identity. So the vectors are calculated again if tensors are added,
+        removed or replaced, but not if a tensor is changed in-place.
+        :param intermediate_parameters: The intermediate parameters the directions are calculated from.
+        :param calculate_vectors: The function which calculates the two direction vectors.
+        :param options: The options of the calculation, which are part of the signature.
+        :return: The two directions in the parameter space.
+        """
+        signature = (
+            len(intermediate_parameters),
+            tuple(id(parameter) for parameters in intermediate_parameters for parameter in parameters),
+            tuple(id(parameter) for parameter in self._optimized_parameters),
+            *options,
+        )
+        if self._cached_directions is None or self._cached_directions[0] != signature:
+            b1, b2 = calculate_vectors()
+            self._cached_directions = (signature, b1, b2)
+        _, b1, b2 = self._cached_directions
+        return self._vectors_to_parameters(b1, b2)
 
     @abstractmethod
     def calculate_directions(self) -> Tuple[List[Tensor], List[Tensor]]:
@@ -88,55 +237,77 @@ class RandomDirections(Directions):
 
         super().__init__(optimized_parameters)
 
-    def calculate_directions(self, apply_normalization: bool = True) -> Tuple[List[Tensor], List[Tensor]]:
+    def calculate_directions(
+        self, apply_normalization: bool = True, seed: Optional[int] = None
+    ) -> Tuple[List[Tensor], List[Tensor]]:
         """
         Gets random directions.
         :param apply_normalization: Set to true to apply filter normalization to the created directions.
+        :param seed: (Optional) The seed of the random number generator, to create reproducible directions.
         :return: [b1, b2] where b1 and b2 are random directions.
         """
-        return self.create_random_directions_from_parameters(self._optimized_parameters, apply_normalization)
+        return self.create_random_directions_from_parameters(self._optimized_parameters, apply_normalization, seed)
 
     @staticmethod
     def create_random_directions_from_parameters(
-        model_parameters: List[Tensor], apply_normalization: bool = True
+        model_parameters: List[Tensor], apply_normalization: bool = True, seed: Optional[int] = None
     ) -> Tuple[List[Tensor], List[Tensor]]:
         """
         Create a random direction for the model.
 
         :param model_parameters: The parameters of the model.
         :param apply_normalization: Set to true, to apply filter normalization.
+        :param seed: (Optional) The seed of the random number generator, to create reproducible directions.
         :return: PyTorch tensor representing random direction.
         """
-        x_direction = RandomDirections.create_random_direction_from_parameters(model_parameters, apply_normalization)
-        y_direction = RandomDirections.create_random_direction_from_parameters(model_parameters, apply_normalization)
+        generator = None
+        if seed is not None:
+            # a single generator is seeded once and creates both directions.
+            generator = Generator(device=model_parameters[0].device)
+            generator.manual_seed(seed)
+        x_direction = RandomDirections.create_random_direction_from_parameters(
+            model_parameters, apply_normalization, generator
+        )
+        y_direction = RandomDirections.create_random_direction_from_parameters(
+            model_parameters, apply_normalization, generator
+        )
         return x_direction, y_direction
 
     @staticmethod
     def create_random_direction_from_parameters(
-        parameters: Iterable[Tensor], apply_filter_normalization: bool = True
+        parameters: Iterable[Tensor], apply_filter_normalization: bool = True, generator: Optional[Generator] = None
     ) -> List[Tensor]:
         """
         Create a random direction for the model.
 
         :param parameters: the parameters of a model.
         :param apply_filter_normalization: Set to true, to apply filter normalization.
+        :param generator: (Optional) The random number generator to use.
         :return: PyTorch tensor representing random direction.
         """
         parameters = [p.data for p in parameters]
-        direction = RandomDirections.get_random_parameters(parameters)
+        direction = RandomDirections.get_random_parameters(parameters, generator)
         if apply_filter_normalization:
             normalize_direction_using_params(direction, parameters)
         return direction
 
     @staticmethod
-    def get_random_parameters(parameters: List[Tensor]) -> List[Tensor]:
+    def get_random_parameters(parameters: List[Tensor], generator: Optional[Generator] = None) -> List[Tensor]:
         """
         Generate random parameters for a given list of parameters.
 
         :param parameters: List containing PyTorch tensors representing parameters of a model.
+        :param generator: (Optional) The random number generator to use. The random numbers are created on its
+        device and moved to the devices of the parameters.
         :return: List containing PyTorch tensors with the same shape as the input list.
         """
-        return [randn(w.size(), device=w.device) for w in parameters]
+        if generator is None and len({w.device for w in parameters}) != 1:
+            return [randn(w.size(), device=w.device) for w in parameters]
+        # draw all random numbers at once and split them up into the shapes of the parameters.
+        random_device = parameters[0].device if generator is None else generator.device
+        sizes = [w.numel() for w in parameters]
+        random_vector = randn(sum(sizes), device=random_device, generator=generator)
+        return [chunk.view(w.size()).to(device=w.device) for chunk, w in zip(random_vector.split(sizes), parameters)]
 
     @staticmethod
     def normalize_direction(direction: List[Tensor], parameters: List[Tensor]):
@@ -163,14 +334,19 @@ class PcaDirections(Directions):
         self,
         optimized_parameters: List[Tensor],
         intermediate_parameters: Union[List[List[Tensor]], List[Tuple[List[Tensor], float]]],
-        covariance_device: device = device("cpu"),
+        covariance_device: Optional[device] = None,
+        low_precision: bool = False,
     ):
         """
         Initializes the pca directions calculations class.
         :param optimized_parameters: The optimized parameters from the model.
         :param intermediate_parameters: The parameters calculated during training with or without the loss.
-        :param covariance_device: The device to use to calculate the covariance matrix. Should be set to a device
-        with lots of memory, because the covariance matrix size is the square of the count of parameters.
+        :param covariance_device: (Optional) The device to use to calculate the principal components, by default the
+        device of the optimized parameters. Should be set to a device which can hold all intermediate parameters at
+        once, e.g. the cpu for models which use most of the gpu memory.
+        :param low_precision: Set to true to multiply the samples in bfloat16 when calculating the gram matrix,
+        which halves the memory traffic of the multiplication. The gram matrix is then used for any count of
+        intermediate parameters.
         """
         super().__init__(optimized_parameters)
         if len(intermediate_parameters) == 0:
@@ -179,101 +355,161 @@ class PcaDirections(Directions):
 
         # Check if intermediate parameters were provided with loss.
         if isinstance(intermediate_parameters[0], tuple):
-            self._intermediate_parameters = [parameters for parameters, loss in intermediate_parameters]
+            self._intermediate_parameters = list(map(itemgetter(0), intermediate_parameters))
         else:
             self._intermediate_parameters = intermediate_parameters
         self._covariance_device = covariance_device
+        self._low_precision = low_precision
 
     def calculate_directions(self) -> Tuple[List[Tensor], List[Tensor]]:
         """
-        Calculates the directions using PCA on the covariance matrix of the intermediate parameters.
+        Calculates the directions using PCA on the covariance matrix of the intermediate parameters. The result of the
+        decomposition is cached, so repeated calls neither flatten the intermediate parameters again nor decompose
+        them.
         :return: Two directions in the parameter space.
         """
-        b1, b2 = PcaDirections.create_pca_directions(
-            self._intermediate_parameters, self._optimized_parameters, pca_device=self._covariance_device
+        return self._calculate_cached_directions(
+            self._intermediate_parameters,
+            lambda: PcaDirections.create_pca_directions(
+                self._intermediate_parameters,
+                self._optimized_parameters,
+                pca_device=self._covariance_device,
+                low_precision=self._low_precision,
+                parameters_vector=self._optimized_parameters_vector,
+            ),
+            self._covariance_device,
+            self._low_precision,
         )
-        b1_param = clone_parameters(self._optimized_parameters)
-        b2_param = clone_parameters(self._optimized_parameters)
-        vector_to_parameters(b1, b1_param)
-        vector_to_parameters(b2, b2_param)
-
-        return b1_param, b2_param
-
-    @staticmethod
-    def calculate_covariance_matrix(samples: List[Tensor]) -> Tensor:
-        """
-        Calculates the covariance matrix of the provided samples with low memory (does not create the matrix
-        holding all the samples).
-        :param samples: A list of the feature vectors for each sample.
-        :return: The covariance matrix.
-        """
-        covariance_matrix = cov(stack(samples, dim=1))
-        return covariance_matrix
 
     @staticmethod
     def create_pca_directions(
-        intermediate_results: List[List[Tensor]], parameters: List[Tensor], pca_device=None
+        intermediate_results: List[List[Tensor]],
+        parameters: List[Tensor],
+        pca_device=None,
+        low_precision: bool = False,
+        parameters_vector: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         """
         Creates directions for visualizing the loss landscape using PCA of the intermediate parameters (which were
         calculated during training).
         :param intermediate_results: List of intermediate parameters.
         :param parameters: The "best" parameters to subtract from each intermediate result.
-        :param pca_device: (optional) The device on which the PCA is calculated.
+        :param pca_device: (optional) The device on which the PCA is calculated, by default the device of the
+        optimized parameters.
+        :param low_precision: Set to true to calculate the gram matrix in bfloat16, which is then used for any count
+        of intermediate results.
+        :param parameters_vector: (optional) The "best" parameters as a vector, if it was already created.
         :return: List containing two basis vectors for the parameter space.
         """
         if len(intermediate_results) == 0:
             raise ValueError("Intermediate results must not be empty.")
-
-        parameters_vector = parameters_to_vector(parameters)
+        if len(intermediate_results) == 1:
+            raise ValueError("At least two intermediate results are required to calculate directions.")
+
+        if parameters_vector is None:
+            parameters_vector = parameters_to_vector(parameters).detach()
+        parameters_vector = parameters_vector.to(device=pca_device)
+        if not parameters_vector.is_floating_point():
+            parameters_vector = parameters_vector.to(dtype=torch.get_default_dtype())
         # subtract the optimized parameters from each intermediate parameter.
-        results = [
-            (parameters_to_vector(result) - parameters_vector).to(device=pca_device) for result in intermediate_results
-        ]
+        results = parameters_to_matrix(
+            intermediate_results, parameters_vector.device, parameters_vector.dtype, zero_point=parameters_vector
+        )
 
-        PcaDirections.logger.debug("Calculating covariance matrix")
-        covariance_matrix = PcaDirections.calculate_covariance_matrix(results)
-        eigen_values, eigen_vectors = PcaDirections._calculate_eigenpairs(covariance_matrix)
+        if results.size(dim=0) == 2:
+            # the only principal component of two samples is their difference. The second direction is taken from
+            # the first sample, so that the plane contains both samples and the optimized parameters.
+            PcaDirections.logger.debug("Using the orthonormalized samples as directions.")
+            eigen_vectors, _ = qr(stack([results[1] - results[0], results[0]], dim=1))
+        else:
+            # center the samples, so that the right singular vectors are the principal components.
+            results -= results.mean(dim=0, keepdim=True)
 
-        _, indices = sort(eigen_values, descending=True)
-        eigen_values_sum = sum(eigen_values)
-        PcaDirections.logger.info("1st PC explains: {}%".format(100 * eigen_values[indices[0]] / eigen_values_sum))
-        PcaDirections.logger.info("2nd PC explains: {}%".format(100 * eigen_values[indices[1]] / eigen_values_sum))
+            PcaDirections.logger.debug("Calculating principal components")
+            eigen_values, eigen_vectors = PcaDirections._calculate_eigenpairs(results, low_precision)
+            if PcaDirections.logger.isEnabledFor(INFO):
+                PcaDirections._log_explained_variance(results, eigen_values)
 
         # store resulting directions on the same device as the optimized parameters.
         target_device = parameters[0].device
-        b1 = eigen_vectors[:, indices[0]].clone().detach().to(device=target_device)
-        b2 = eigen_vectors[:, indices[1]].clone().detach().to(device=target_device)
+        b1 = eigen_vectors[:, 0].clone().detach().to(device=target_device)
+        b2 = eigen_vectors[:, 1].clone().detach().to(device=target_device)
 
         return b1, b2
 
     @staticmethod
-    def _calculate_eigenpairs(covariance_matrix: Tensor) -> Tuple[Tensor, Tensor]:
+    def _log_explained_variance(samples: Tensor, eigen_values: Tensor):
         """
-        Calculates the eigenpairs of the covariance matrix.
-        :param covariance_matrix: The covariance matrix.
-        :return: The eigenvalues and eigen vectors.
+        Logs the ratio of the variance explained by the first two principal components.
+        :param samples: The centered samples as matrix of size NxF.
+        :param eigen_values: The eigenvalues of the covariance matrix in descending order.
         """
-        # Check if LOBPCG algorithm can be used: rows of matrix must be larger than 3x(number of eigenpairs=2).
-        if covariance_matrix.size(dim=0) > 3 * 2:
-            PcaDirections.logger.debug("Using LOBPCG algorithm to calculate eigenpairs.")
-            eigen_values, eigen_vectors = lobpcg(covariance_matrix, largest=True, k=2)
+        # the sum of all eigenvalues of the covariance matrix is its trace, i.e. the total variance of the samples.
+        eigen_values_sum = samples.pow(2).sum() / max(samples.size(dim=0) - 1, 1)
+        # fetch all values with a single synchronization.
+        first_eigen_value, second_eigen_value, eigen_values_sum = torch.cat(
+            [eigen_values[:2], eigen_values_sum.reshape(1)]
+        ).tolist()
+        PcaDirections.logger.info("1st PC explains: {}%".format(100 * first_eigen_value / eigen_values_sum))
+        PcaDirections.logger.info("2nd PC explains: {}%".format(100 * second_eigen_value / eigen_values_sum))
+
+    @staticmethod
+    def calculate_gram_matrix(samples: Tensor, low_precision: bool = False) -> Tensor:
+        """
+        Calculates the gram matrix of the centered samples, normalized like the covariance matrix. It has the same
+        non-zero eigenvalues as the covariance matrix, but its size is the square of the count of samples instead
+        of the square of the count of features.
+        :param samples: The centered samples as matrix of size NxF.
+        :param low_precision: Set to true to multiply the samples in bfloat16. The gram matrix is returned in the
+        dtype of the samples.
+        :return: The gram matrix of size NxN.
+        """
+        if low_precision:
+            low_precision_samples = samples.to(dtype=torch.bfloat16)
+            gram_matrix = (low_precision_samples @ low_precision_samples.T).to(dtype=samples.dtype)
         else:
-            PcaDirections.logger.debug("Using torch.linalg.eigh to calculate eigenpairs.")
-            eigen_values, eigen_vectors = eigh(covariance_matrix)
+            gram_matrix = samples @ samples.T
+        return gram_matrix / max(samples.size(dim=0) - 1, 1)
+
+    @staticmethod
+    def _calculate_eigenpairs(samples: Tensor, low_precision: bool = False) -> Tuple[Tensor, Tensor]:
+        """
+        Calculates the two largest eigenpairs of the covariance matrix of the centered samples, without creating
+        the covariance matrix.
+        :param samples: The centered samples as matrix of size NxF.
+        :param low_precision: Set to true to calculate the gram matrix in bfloat16, which is then used for any count
+        of samples.
+        :return: The eigenvalues in descending order and the eigenvectors as columns.
+        """
+        samples_count = samples.size(dim=0)
+        if low_precision or samples_count <= GRAM_MAX_SAMPLES:
+            PcaDirections.logger.debug("Using torch.linalg.eigh on the gram matrix to calculate eigenpairs.")
+            gram_matrix = PcaDirections.calculate_gram_matrix(samples, low_precision)
+            eigen_values, eigen_vectors = calculate_gram_eigenpairs(samples, gram_matrix)
+        else:
+            PcaDirections.logger.debug("Using a randomized range finder to calculate eigenpairs.")
+            singular_values, eigen_vectors = calculate_randomized_singular_vectors(
+                samples, oversampling=10, iterations=2
+            )
+            eigen_values = singular_values**2 / (samples_count - 1)
         return eigen_values, eigen_vectors
 
+
 class SvdDirections(Directions):
     """
     Calculates directions using the intermediate parameters calculated during training.
     """
 
     logger = getLogger("visualizations_directions")
+    # the maximal count of intermediate results for which the directions are calculated using the gram matrix.
+    gram_max_samples = GRAM_MAX_SAMPLES
 
     def __init__(
         self,
         optimized_parameters: List[Tensor],
         intermediate_parameters: Union[List[List[Tensor]], List[Tuple[List[Tensor], float]]],
+        low_memory: bool = False,
+        low_precision: bool = False,
     ):
         """
         Initializes the pca directions calculations class.
@@ -284,6 +520,10 @@ class SvdDirections(Directions):
         :param training_epochs: The count of epochs to train the autoencoder.
         :param early_stopping_epochs: The count of epochs in which no progress is made until training is stopped.
         with lots of memory, because the covariance matrix size is the square of the count of parameters.
+        :param low_memory: Set to true to calculate the directions without creating the matrix of all intermediate
+        parameters, for models which are too large to hold another copy of the intermediate parameters.
+        :param low_precision: Set to true to store the matrix of the intermediate parameters in bfloat16, which halves
+        its memory. The gram matrix is decomposed in float32. Not used if low_memory is set.
         """
         super().__init__(optimized_parameters)
         if len(intermediate_parameters) == 0:
@@ -292,30 +532,38 @@ class SvdDirections(Directions):
 
         # Check if intermediate parameters were provided with loss.
         if isinstance(intermediate_parameters[0], tuple):
-            self._intermediate_parameters = [parameters for parameters, loss in intermediate_parameters]
+            self._intermediate_parameters = list(map(itemgetter(0), intermediate_parameters))
         else:
             self._intermediate_parameters = intermediate_parameters
+        self._low_memory = low_memory
+        self._low_precision = low_precision
 
     def calculate_directions(self) -> Tuple[List[Tensor], List[Tensor]]:
         """
-        Calculates the directions using PCA on the covariance matrix of the intermediate parameters.
+        Calculates the directions using PCA on the covariance matrix of the intermediate parameters. The result of the
+        decomposition is cached, so repeated calls only create new parameter lists.
         :return: Two directions in the parameter space.
         """
-        b1, b2 = SvdDirections.create_learnable_directions(
+        return self._calculate_cached_directions(
             self._intermediate_parameters,
-            self._optimized_parameters,
+            lambda: SvdDirections.create_learnable_directions(
+                self._intermediate_parameters,
+                self._optimized_parameters,
+                parameters_vector=self._optimized_parameters_vector,
+                low_memory=self._low_memory,
+                low_precision=self._low_precision,
+            ),
+            self._low_memory,
+            self._low_precision,
         )
-        b1_param = clone_parameters(self._optimized_parameters)
-        b2_param = clone_parameters(self._optimized_parameters)
-        vector_to_parameters(b1, b1_param)
-        vector_to_parameters(b2, b2_param)
-
-        return b1_param, b2_param
 
     @staticmethod
     def create_learnable_directions(
         intermediate_results: List[List[Tensor]],
         parameters: List[Tensor],
+        parameters_vector: Optional[Tensor] = None,
+        low_memory: bool = False,
+        low_precision: bool = False,
     ) -> Tuple[Tensor, Tensor]:
         """
         Creates directions for visualizing the loss landscape using PCA of the intermediate parameters (which were
@@ -326,23 +574,149 @@ class SvdDirections(Directions):
         :param autoencoder_lr: The learning rate used for training the autoencoder.
         :param training_epochs: The count of epochs to train the autoencoder.
         :param early_stopping_epochs: The count of epochs in which no progress is made until training is stopped.
+        :param parameters_vector: (optional) The "best" parameters as a vector, if it was already created.
+        :param low_memory: Set to true to stream the intermediate parameters instead of creating the NxF matrix.
+        :param low_precision: Set to true to create the NxF matrix in bfloat16. The directions are calculated from the
+        float32 gram matrix, also for many intermediate results.
         :return: List containing two basis vectors for the parameter space.
         """
         if len(intermediate_results) == 0:
             raise ValueError("Intermediate results must not be empty.")
-
-        optimized_parameters_vector = parameters_to_vector(parameters)
-        # subtract the optimized parameters from each intermediate parameter.
-        x = [(parameters_to_vector(result) - optimized_parameters_vector) for result in intermediate_results]
-        dataset = stack(x).to(dtype=torch.float32)  # matrix of size NxF
-        # feature_dim = len(x[0])
+        if len(intermediate_results) == 1:
+            raise ValueError("At least two intermediate results are required to calculate directions.")
+
+        if parameters_vector is None:
+            parameters_vector = parameters_to_vector(parameters).detach()
+        if low_memory:
+            V = SvdDirections._calculate_streamed_singular_vectors(intermediate_results, parameters_vector)
+            return V[:, 0], V[:, 1]
+        # subtract the optimized parameters from each intermediate parameter, the differences are cast to float32
+        # (or bfloat16) while they are written into the matrix of size NxF.
+        dataset_dtype = torch.bfloat16 if low_precision else torch.float32
+        dataset = parameters_to_matrix(
+            intermediate_results, parameters_vector.device, dataset_dtype, zero_point=parameters_vector
+        )
         # https://arxiv.org/pdf/1404.1100
+        calculate_singular_vectors = SvdDirections._singular_vectors_function(dataset.size(dim=0), low_precision)
+        V = calculate_singular_vectors(dataset)
 
-        # using full SVD:
-        # U, S, Vh = svd(dataset, full_matrices=True)
-        # V = Vh.T
-        U, S, V = svd_lowrank(dataset, q=2)
-
-        b1 = V[:, 0]
-        b2 = V[:, 1]
+        # the columns are copied, so they do not keep the (C+P)xF basis of the randomized range finder alive.
+        del dataset
+        b1 = V[:, 0].clone()
+        b2 = V[:, 1].clone()
         return b1, b2
+
+    @staticmethod
+    def _singular_vectors_function(samples_count: int, low_precision: bool = False) -> Callable[[Tensor], Tensor]:
+        """
+        Selects the function which calculates the two largest right singular vectors of the dataset, by the count
+        of intermediate results.
+        :param samples_count: The count of intermediate results.
+        :param low_precision: True if the dataset is stored in bfloat16, which is only supported by the gram route.
+        :return: The function, which gets the dataset of size NxF and returns the singular vectors as columns.
+        """
+        if low_precision or samples_count <= SvdDirections.gram_max_samples:
+            return SvdDirections._gram_singular_vectors
+        return SvdDirections._randomized_singular_vectors
+
+    @staticmethod
+    def _gram_singular_vectors(dataset: Tensor) -> Tensor:
+        """
+        Calculates the top right singular vectors of the dataset from the eigenvectors of the small NxN gram matrix,
+        because usually there are much less intermediate results than parameters.
+        :param dataset: The dataset of size NxF.
+        :return: The singular vectors as columns.
+        """
+        gram_matrix = (dataset @ dataset.T).to(dtype=torch.float32)
+        _, V = calculate_gram_eigenpairs(dataset, gram_matrix)
+        return V
+
+    @staticmethod
+    def _randomized_singular_vectors(dataset: Tensor) -> Tensor:
+        """
+        Calculates the top right singular vectors of the dataset with a randomized range finder, which is cheaper than
+        the gram matrix for many intermediate results. The power iterations keep the approximation accurate for the
+        slowly decaying spectrum of training trajectories.
+        :param dataset: The dataset of size NxF.
+        :return: The singular vectors as columns.
+        """
+        _, V = calculate_randomized_singular_vectors(dataset, oversampling=10, iterations=2)
+        return V
+
+    @staticmethod
+    def create_learnable_directions_batched(
+        batch_of_intermediate_results: List[List[List[Tensor]]],
+        batch_of_parameters: List[List[Tensor]],
+    ) -> List[Tuple[Tensor, Tensor]]:
+        """
+        Creates the directions of multiple models or training runs at once. The intermediate results of all runs are
+        stacked into a batch, so the directions are calculated with one batched matrix multiplication and one batched
+        eigendecomposition of the gram matrices instead of one decomposition per run.
+        :param batch_of_intermediate_results: The intermediate parameters of each run. All runs must have the same
+        count of intermediate results and the same count of parameters.
+        :param batch_of_parameters: The "best" parameters of each run.
+        :return: The two basis vectors of the parameter space for each run.
+        """
+        if len(batch_of_intermediate_results) != len(batch_of_parameters):
+            raise ValueError("The count of intermediate results and parameters must be equal.")
+        if len(batch_of_intermediate_results) == 0:
+            return []
+        samples_counts = {len(intermediate_results) for intermediate_results in batch_of_intermediate_results}
+        if samples_counts == {0}:
+            raise ValueError("Intermediate results must not be empty.")
+        if samples_counts == {1}:
+            raise ValueError("At least two intermediate results are required to calculate directions.")
+        if len(samples_counts) != 1:
+            raise ValueError("All runs must have the same count of intermediate results.")
+
+        first_parameters = batch_of_parameters[0]
+        dataset_batch = torch.empty(
+            len(batch_of_parameters),
+            samples_counts.pop(),
+            sum(parameter.numel() for parameter in first_parameters),
+            device=first_parameters[0].device,
+            dtype=torch.float32,
+        )
+        # each run is written directly into its slice of the batch, which raises if the count of parameters differs.
+        for dataset, intermediate_results, parameters in zip(
+            dataset_batch, batch_of_intermediate_results, batch_of_parameters
+        ):
+            parameters_vector = parameters_to_vector(parameters).detach()
+            parameters_to_matrix(intermediate_results, zero_point=parameters_vector, out=dataset)
+        _, V = calculate_gram_eigenpairs(dataset_batch, dataset_batch @ dataset_batch.mT)
+        return [(V_i[:, 0], V_i[:, 1]) for V_i in V]
+
+    @staticmethod
+    @torch.no_grad()
+    def _calculate_streamed_singular_vectors(
+        intermediate_results: List[List[Tensor]], parameters_vector: Tensor, count: int = 2
+    ) -> Tensor:
+        """
+        Calculates the largest right singular vectors of the intermediate results minus the optimized parameters,
+        holding only two of them as vectors at a time. The gram matrix is accumulated from the inner products of
+        all pairs, and the singular vectors are accumulated from the eigenvectors of the gram matrix in a second pass.
+        Autograd is disabled, so no vector is kept alive for the backward pass of snapshots which require grad.
+        :param intermediate_results: List of intermediate parameters.
+        :param parameters_vector: The "best" parameters as a vector.
+        :param count: The count of singular vectors to calculate.
+        :return: The singular vectors as columns.
+        """
+
+        def difference_vector(result: List[Tensor]) -> Tensor:
+            return parameters_to_vector(result).detach().to(dtype=torch.float32).sub_(parameters_vector)
+
+        samples_count = len(intermediate_results)
+        gram_matrix = torch.empty(samples_count, samples_count, device=parameters_vector.device)
+        for i, result_i in enumerate(intermediate_results):
+            difference_i = difference_vector(result_i)
+            for j, result_j in enumerate(intermediate_results[:i]):
+                gram_matrix[i, j] = gram_matrix[j, i] = torch.dot(difference_i, difference_vector(result_j))
+            gram_matrix[i, i] = torch.dot(difference_i, difference_i)
+
+        _, gram_eigen_vectors = calculate_largest_eigenpairs(gram_matrix, count)
+        singular_vectors = torch.zeros(parameters_vector.numel(), count, device=parameters_vector.device)
+        for result, gram_eigen_vector_row in zip(intermediate_results, gram_eigen_vectors):
+            singular_vectors.addr_(difference_vector(result), gram_eigen_vector_row)
+        # qr normalizes the singular vectors and completes the basis for zero singular values.
+        singular_vectors, _ = qr(singular_vectors)
+        return singular_vectors
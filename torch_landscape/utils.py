@@ -1,7 +1,8 @@
 import os
+from functools import reduce
 from typing import Iterable, List, Optional
 
-from torch import Tensor, device, no_grad
+from torch import Tensor, cuda, device, dtype, empty, no_grad, promote_types, sub
 from torch.nn import Module
 
 
@@ -49,6 +50,68 @@ def clone_parameters(parameters: Iterable[Tensor], detach=False) -> List[Tensor]
         return [param.clone() for param in parameters]
 
 
+def parameters_to_matrix(
+    parameters_list: Iterable[Iterable[Tensor]],
+    to_device: Optional[device] = None,
+    to_dtype: Optional[dtype] = None,
+    zero_point: Optional[Tensor] = None,
+    out: Optional[Tensor] = None,
+) -> Tensor:
+    """
+    Flattens the parameters of multiple models into the rows of a single matrix, without creating an intermediate
+    vector for each model.
+    :param parameters_list: The parameters of each model, all with the same shapes.
+    :param to_device: (Optional) The device of the matrix, by default the device of the first parameter.
+    :param to_dtype: (Optional) The dtype of the matrix, by default the promoted dtype of the parameters.
+    :param zero_point: (Optional) A vector of size F, which is subtracted from each row.
+    :param out: (Optional) A matrix of size NxF to write into, e.g. a slice of a larger batch. If it is set, its
+    device and dtype are used instead of to_device and to_dtype.
+    :return: The matrix of size NxF, where N is the count of models and F the count of parameters of a model.
+    """
+    parameters_list = [[*parameters] for parameters in parameters_list]
+    first_parameters = parameters_list[0]
+    parameters_count = sum(parameter.numel() for parameter in first_parameters)
+    if out is not None:
+        to_device, to_dtype = out.device, out.dtype
+    to_device = first_parameters[0].device if to_device is None else device(to_device)
+    if to_dtype is None:
+        to_dtype = reduce(promote_types, (parameter.dtype for parameter in first_parameters))
+    if out is not None and out.shape != (len(parameters_list), parameters_count):
+        raise ValueError("The output matrix must have the size NxF.")
+
+    # copies from the gpu into pinned memory do not block, so all copies are queued before waiting once.
+    use_pinned_memory = to_device.type == "cpu" and first_parameters[0].is_cuda
+    if out is not None:
+        use_pinned_memory = use_pinned_memory and out.is_pinned()
+        matrix = out
+    else:
+        matrix = empty(
+            len(parameters_list), parameters_count, device=to_device, dtype=to_dtype, pin_memory=use_pinned_memory
+        )
+    # the subtraction is done while copying, if the parameters are already on the device of the matrix.
+    subtract_while_copying = zero_point is not None and first_parameters[0].device == to_device
+    if zero_point is not None:
+        zero_point = zero_point.to(device=to_device)
+    # the parameters are copied as data, snapshots of a model usually require grad.
+    with no_grad():
+        for row, parameters in zip(matrix, parameters_list):
+            offset = 0
+            for parameter in parameters:
+                count = parameter.numel()
+                if subtract_while_copying:
+                    sub(parameter.reshape(-1), zero_point[offset : offset + count], out=row[offset : offset + count])
+                else:
+                    row[offset : offset + count].copy_(parameter.reshape(-1), non_blocking=use_pinned_memory)
+                offset += count
+            if offset != parameters_count:
+                raise ValueError("All parameters must have the same count of elements.")
+        if use_pinned_memory:
+            cuda.synchronize(first_parameters[0].device)
+        if zero_point is not None and not subtract_while_copying:
+            matrix -= zero_point
+    return matrix
+
+
 def move_parameters(parameters: Iterable[Tensor], to_device: device) -> List[Tensor]:
     """
     Moves the parameters in the list to another device.